@@ -23,31 +23,44 @@ Requirements:
 """
 
 import asyncio
+import concurrent.futures
 import contextlib
+import copy
 import dataclasses
 import datetime as dt
+import functools
 import json
 import logging
 import os
 import re
+import secrets
 import shutil
 import sqlite3
+import stat
 import sys
+import threading
 import time
-import uuid
 from pathlib import Path
 from typing import Any, Dict, Optional, Tuple, List
 
+try:
+    import orjson  # optional: faster JSON for Telegram API request/response bodies
+except ImportError:
+    orjson = None
+
 from aiogram import Bot, Dispatcher, F, Router
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
-from aiogram.filters import Command, CommandStart
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import (
     Message,
     CallbackQuery,
+    FSInputFile,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
-from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 # --- Config -----------------------------------------------------------------
 
@@ -56,18 +69,45 @@ if not BOT_TOKEN:
     print("ERROR: BOT_TOKEN env var is required")
     sys.exit(1)
 
-ADMIN_ID = int(os.getenv("ADMIN_ID", "0") or "0")
+# .env ships OWNER_ID; ADMIN_ID is the older name and still wins when set
+ADMIN_ID = int(os.getenv("ADMIN_ID") or os.getenv("OWNER_ID") or "0")
 DOWNLOAD_DIR = Path(os.getenv("DOWNLOAD_DIR", "/root/dl/out")).expanduser()
 DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 DB_PATH = Path(os.getenv("DB_PATH", "bot.db")).expanduser()
+MAX_CONCURRENT = int(os.getenv("MAX_CONCURRENT", "3") or "3")
+DL_WORKERS = int(os.getenv("DL_WORKERS", "8") or "8")
+MAX_URLS_PER_MSG = int(os.getenv("MAX_URLS_PER_MSG", "5") or "5")
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "30") or "30")
+# yt-dlp transfer tuning: parallel HLS/DASH fragments and HTTP range size
+_DEFAULT_FRAGMENTS = min(16, max(4, (os.cpu_count() or 2) * 2))
+YTDLP_FRAGMENTS = int(os.getenv("YTDLP_FRAGMENTS") or _DEFAULT_FRAGMENTS)
+YTDLP_CHUNK_MB = int(os.getenv("YTDLP_CHUNK_MB", "10") or "10")
+YTDLP_BUFFER_KB = int(os.getenv("YTDLP_BUFFER_KB", "1024") or "1024")
+# USE_ARIA2C=1 sends plain HTTP(S) files through aria2c (16 connections) if it's
+# installed; HLS/DASH keep yt-dlp's native fragment downloader. Opt-in: aria2c
+# runs without progress hooks, so Cancel only takes effect once its file is done.
+ARIA2C = shutil.which("aria2c") if os.getenv("USE_ARIA2C", "0") == "1" else None
+# drop a job's folder once its file reached Telegram (default: keep, /clean purges)
+DELETE_AFTER_UPLOAD = os.getenv("DELETE_AFTER_UPLOAD", "0") == "1"
+# read size for uploads (aiogram's default is 64 KiB: ~30k thread hops for 1.9 GB)
+UPLOAD_CHUNK_KB = int(os.getenv("UPLOAD_CHUNK_KB", "1024") or "1024")
 
 # --- Database ---------------------------------------------------------------
 
+_CON: Optional[sqlite3.Connection] = None
+
 def db() -> sqlite3.Connection:
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    return con
+    # One connection for the whole process (all callers run on the event loop
+    # thread). WAL + synchronous=NORMAL makes each status update an append
+    # instead of a full journal rewrite + fsync.
+    global _CON
+    if _CON is None:
+        _CON = sqlite3.connect(DB_PATH)
+        _CON.row_factory = sqlite3.Row
+        _CON.execute("PRAGMA journal_mode=WAL")
+        _CON.execute("PRAGMA synchronous=NORMAL")
+    return _CON
 
 def init_db() -> None:
     con = db()
@@ -85,6 +125,8 @@ def init_db() -> None:
             created_at INTEGER NOT NULL,
             updated_at INTEGER NOT NULL
         )""")
+        # /status groups by status: answer it from the index, not the wide rows
+        con.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status)")
         con.execute("""
         CREATE TABLE IF NOT EXISTS cookies (
             user_id INTEGER NOT NULL,
@@ -92,21 +134,35 @@ def init_db() -> None:
             cookie  TEXT NOT NULL,
             PRIMARY KEY (user_id, domain)
         )""")
-    con.close()
+        # nothing runs before startup: rows still running/queued were cut off
+        # by a crash, restart or shutdown cancel and would never be purged
+        con.execute(
+            "UPDATE jobs SET status = 'failed', updated_at = ? WHERE status IN ('running', 'queued')",
+            (now_ts(),),
+        )
 
 # --- Utilities --------------------------------------------------------------
 
-URL_RE = re.compile(r"(https?://[^\s]+)", re.IGNORECASE)
+URL_RE = re.compile(r"https?://\S+", re.IGNORECASE)
 
 def extract_url(text: str) -> Optional[str]:
-    if not text:
+    # cheap substring test first: most chat text never reaches the regex
+    if not text or "://" not in text:
         return None
     m = URL_RE.search(text)
-    return m.group(1) if m else None
+    return m.group(0) if m else None
+
+def extract_urls(text: str) -> List[str]:
+    # every URL in the message, first occurrence wins
+    if not text or "://" not in text:
+        return []
+    return list(dict.fromkeys(URL_RE.findall(text)))
+
+_DOMAIN_RE = re.compile(r"https?://([^/]+)", re.IGNORECASE)
 
 def domain_from_url(url: str) -> str:
     # simple & safe
-    m = re.match(r"https?://([^/]+)", url)
+    m = _DOMAIN_RE.match(url)
     return (m.group(1) if m else "").lower()
 
 def now_ts() -> int:
@@ -124,17 +180,76 @@ def disk_usage_str(path: Path) -> str:
     total, used, free = shutil.disk_usage(path)
     return f"Used {human_bytes(used)} / Total {human_bytes(total)} (Free {human_bytes(free)})"
 
+def purge_old_files(root: Path, max_age: float) -> int:
+    # one scandir pass; DirEntry caches the type and the single stat() per entry.
+    # Per-job directories go as a whole once nothing in them was touched recently.
+    cutoff = time.time() - max_age
+    removed = 0
+    with os.scandir(root) as it:
+        for entry in it:
+            with contextlib.suppress(OSError):
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                    removed += 1
+                elif entry.is_file():
+                    os.unlink(entry.path)
+                    removed += 1
+    return removed
+
 def sanitized_cookie_preview(cookie: str) -> str:
     # Hide everything except cookie keys
     keys = [kv.split("=")[0].strip() for kv in cookie.split(";") if "=" in kv]
     return "; ".join(f"{k}=***" for k in keys[:10])
 
+FFMPEG_CHECK_TTL = 30.0
+_ffmpeg_checked_at: Optional[float] = None
+_ffmpeg_ok = False
+
 def ffmpeg_present() -> bool:
-    return shutil.which("ffmpeg") is not None
+    # shutil.which walks every PATH dir; re-check only every FFMPEG_CHECK_TTL
+    # seconds so an install made while the bot runs is still picked up
+    global _ffmpeg_checked_at, _ffmpeg_ok
+    now = time.monotonic()
+    if _ffmpeg_checked_at is None or now - _ffmpeg_checked_at >= FFMPEG_CHECK_TTL:
+        _ffmpeg_ok = shutil.which("ffmpeg") is not None
+        _ffmpeg_checked_at = now
+    return _ffmpeg_ok
+
+def _fadvise(path: Path, advice: int) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+@contextlib.asynccontextmanager
+async def upload_cache_hints(path: Path):
+    """
+    Wrap a single front-to-back read of `path` (the upload). Marks the file
+    as sequentially read (bigger readahead) and drops its pages afterwards,
+    so a multi-GB video doesn't evict everything else from the page cache.
+    Both hints are per-file, so they apply to whichever handle does the
+    reading. The syscalls run in a thread; no-op without posix_fadvise.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        yield
+        return
+    await asyncio.to_thread(_fadvise, path, os.POSIX_FADV_SEQUENTIAL)
+    try:
+        yield
+    finally:
+        await asyncio.to_thread(_fadvise, path, os.POSIX_FADV_DONTNEED)
 
 # --- Job model --------------------------------------------------------------
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Job:
     jid: str
     user_id: int
@@ -163,7 +278,8 @@ class Job:
         )
 
 def job_create(user_id: int, url: str, fmt: Optional[str] = None, force_generic: bool = False) -> Job:
-    jid = str(uuid.uuid4())
+    # 64 random bits: ids are persisted, so a restart-reset counter would collide
+    jid = secrets.token_hex(8)
     j = Job(jid=jid, user_id=user_id, url=url, fmt=fmt, force_generic=force_generic)
     con = db()
     with con:
@@ -171,16 +287,12 @@ def job_create(user_id: int, url: str, fmt: Optional[str] = None, force_generic:
             INSERT INTO jobs (jid, user_id, url, fmt, force_generic, status, filepath, log, created_at, updated_at)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (j.jid, j.user_id, j.url, j.fmt, int(j.force_generic), j.status, j.filepath, j.log, j.created_at, j.updated_at))
-    con.close()
     return j
 
 def job_get(jid: str) -> Optional[Job]:
     con = db()
-    try:
-        row = con.execute("SELECT * FROM jobs WHERE jid=?", (jid,)).fetchone()
-        return Job.from_row(row) if row else None
-    finally:
-        con.close()
+    row = con.execute("SELECT * FROM jobs WHERE jid=?", (jid,)).fetchone()
+    return Job.from_row(row) if row else None
 
 def job_update(j: Job) -> None:
     j.updated_at = now_ts()
@@ -190,15 +302,21 @@ def job_update(j: Job) -> None:
             UPDATE jobs SET fmt=?, force_generic=?, status=?, filepath=?, log=?, updated_at=?
             WHERE jid=?
         """, (j.fmt, int(j.force_generic), j.status, j.filepath, j.log, j.updated_at, j.jid))
-    con.close()
 
+def job_purge(max_age: int) -> int:
+    # finished/abandoned rows only; a panel whose job is gone rebuilds it from the URL
+    cutoff = now_ts() - max_age
+    con = db()
+    with con:
+        cur = con.execute("DELETE FROM jobs WHERE status != 'running' AND updated_at < ?", (cutoff,))
+    return cur.rowcount
+
+# looked up on every download, panel "Show command" and retry; cleared on save
+@functools.lru_cache(maxsize=1024)
 def cookie_get(user_id: int, domain: str) -> Optional[str]:
     con = db()
-    try:
-        row = con.execute("SELECT cookie FROM cookies WHERE user_id=? AND domain=?", (user_id, domain)).fetchone()
-        return row["cookie"] if row else None
-    finally:
-        con.close()
+    row = con.execute("SELECT cookie FROM cookies WHERE user_id=? AND domain=?", (user_id, domain)).fetchone()
+    return row["cookie"] if row else None
 
 def cookie_set(user_id: int, domain: str, cookie: str) -> None:
     con = db()
@@ -208,7 +326,78 @@ def cookie_set(user_id: int, domain: str, cookie: str) -> None:
             VALUES (?, ?, ?)
             ON CONFLICT(user_id, domain) DO UPDATE SET cookie=excluded.cookie
         """, (user_id, domain, cookie.strip()))
-    con.close()
+    cookie_get.cache_clear()
+
+# --- Admission --------------------------------------------------------------
+
+class Admission:
+    """
+    Caps how many downloads run at once. Unlike asyncio.Semaphore the cap can
+    be changed at runtime (/setconcurrent) without touching private state:
+    raising it wakes waiters, lowering it lets running jobs drain first.
+    The cap never exceeds `limit` (the YDL_POOL size): past that, admitted
+    jobs would only wait unseen in the pool's queue while shown as running.
+    """
+    def __init__(self, cap: int, limit: int):
+        self.limit = max(1, limit)
+        self.cap = min(self.limit, max(1, cap))
+        self.active = 0
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def full(self) -> bool:
+        return self.active >= self.cap
+
+    async def _acquire(self, cancel: Optional[threading.Event]) -> bool:
+        canceled = (lambda: cancel.is_set()) if cancel is not None else (lambda: False)
+        async with self._cond:
+            self.waiting += 1
+            try:
+                await self._cond.wait_for(lambda: canceled() or self.active < self.cap)
+            finally:
+                self.waiting -= 1
+            if canceled():
+                return False
+            self.active += 1
+            return True
+
+    async def _release(self) -> None:
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify(1)
+
+    async def __aenter__(self) -> "Admission":
+        await self._acquire(None)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self._release()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cancel: threading.Event):
+        """
+        Like `async with ADMISSION`, but leaves the line as soon as `cancel`
+        is set (see wake()). Yields False, without taking a slot, in that case.
+        """
+        admitted = await self._acquire(cancel)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                await self._release()
+
+    async def wake(self) -> None:
+        # re-check waiters' predicates, e.g. after a queued job was canceled
+        async with self._cond:
+            self._cond.notify_all()
+
+    async def set_cap(self, cap: int) -> None:
+        async with self._cond:
+            self.cap = min(self.limit, max(1, cap))
+            self._cond.notify_all()
+
+ADMISSION = Admission(MAX_CONCURRENT, DL_WORKERS)
 
 # --- YT-DLP wrapper ---------------------------------------------------------
 
@@ -220,6 +409,13 @@ def _import_yt_dlp():
     except Exception as e:
         return None
 
+# yt-dlp gets its own threads so long downloads can't starve the loop's
+# default executor (used by to_thread for disk work and by aiogram).
+YDL_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DL_WORKERS, thread_name_prefix="ytdl")
+
+async def run_in_ydl_pool(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(YDL_POOL, fn, *args)
+
 class BufferLogger(logging.Logger):
     def __init__(self, name="ydl", level=logging.INFO):
         super().__init__(name, level=level)
@@ -240,25 +436,131 @@ class BufferLogger(logging.Logger):
         self.buf.append(s)
         super().error(msg, *args, **kwargs)
 
+# Raw extractor results (before format selection), keyed by
+# (url, force_generic, cookie). Picking another quality or retrying reuses
+# them instead of re-running the site extractor. Kept short because the media
+# URLs inside are usually signed and expire.
+INFO_TTL = float(os.getenv("METADATA_TTL", "600") or "600")
+INFO_CACHE_MAX = int(os.getenv("METADATA_CACHE_MAX", "64") or "64")
+_INFO_CACHE: Dict[Tuple[str, bool, str], Tuple[float, dict]] = {}
+
+def info_cache_get(key: Tuple[str, bool, str]) -> Optional[dict]:
+    hit = _INFO_CACHE.get(key)
+    if hit is None:
+        return None
+    if time.monotonic() - hit[0] > INFO_TTL:
+        _INFO_CACHE.pop(key, None)
+        return None
+    return hit[1]
+
+def info_cache_put(key: Tuple[str, bool, str], ie_result: dict) -> None:
+    now = time.monotonic()
+    _INFO_CACHE.pop(key, None)  # re-insert so dict order stays oldest-first
+    _INFO_CACHE[key] = (now, ie_result)
+    # info dicts can be large: sweep expired entries, then cap the size
+    for k in [k for k, (ts, _) in _INFO_CACHE.items() if now - ts > INFO_TTL]:
+        del _INFO_CACHE[k]
+    while len(_INFO_CACHE) > INFO_CACHE_MAX:
+        del _INFO_CACHE[next(iter(_INFO_CACHE))]
+
+def info_cache_drop(url: str) -> None:
+    for key in [k for k in _INFO_CACHE if k[0] == url]:
+        _INFO_CACHE.pop(key, None)
+
+# Lowercased substrings of yt-dlp errors for streams it can't decrypt
+DRM_MARKERS = ("this video is drm protected", "unsupported drm", "encrypted")
+
+# Failures (lowercased substrings) that a generic-extractor retry can't fix:
+# access denied, missing/removed content, DNS. Anything else gets one retry.
+NO_GENERIC_RETRY = (
+    "http error 401",
+    "http error 403",
+    "http error 404",
+    "http error 410",
+    "name or service not known",
+    "nodename nor servname",
+    "failed to resolve",
+    "private video",
+    "sign in to confirm",
+    "video unavailable",
+    "has been removed",
+    "not available in your country",
+    "geo restriction",
+    "login required",
+    "requires authentication",
+    "members-only",
+    "members only",
+)
+
+# request headers shared by every job; run_download adds the user's Cookie
+BASE_HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+OUTTMPL_NAME = "%(title).200B [%(id)s].%(ext)s"
+
+def job_dir(jid: str) -> Path:
+    # one directory per job keeps lookups and cleanup independent of history
+    return DOWNLOAD_DIR / jid
+
+# defaults tuned for mp4 merges; anything unknown gets the best-quality selector
+FORMAT_SELECTORS = {
+    "best": "bv*+ba/b",  # best video+audio, fallback to best
+    "1080p": "bv*[height<=1080]+ba/b[height<=1080]",
+    "720p": "bv*[height<=720]+ba/b[height<=720]",
+}
+
 def build_format_selector(choice: Optional[str]) -> str:
-    # defaults tuned for mp4 merges
-    if not choice or choice == "best":
-        return "bv*+ba/b"  # best video+audio, fallback to best
-    if choice == "1080p":
-        return "bv*[height<=1080]+ba/b[height<=1080]"
-    if choice == "720p":
-        return "bv*[height<=720]+ba/b[height<=720]"
-    # as a safe fallback
-    return "bv*+ba/b"
+    return FORMAT_SELECTORS.get(choice or "best", FORMAT_SELECTORS["best"])
+
+def uses_aria2c(user_cookie: Optional[str]) -> bool:
+    # yt-dlp hands aria2c the headers as --header arguments, readable by any
+    # local user via /proc; jobs with a user's cookie stay in-process
+    return bool(ARIA2C) and not user_cookie
+
+def _file_size(p: Path) -> Optional[int]:
+    # one stat answers both "is it there" and "how big"
+    try:
+        st = p.stat()
+    except OSError:
+        return None
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+def locate_output(info: dict, predicted: Path, out_dir: Path) -> Optional[Path]:
+    """Find the finished file for `info`; runs in the download thread."""
+    # 1) new 'requested_downloads' API: the largest file (the merged one)
+    rds = info.get("requested_downloads") if isinstance(info, dict) else None
+    if isinstance(rds, list) and rds:
+        candidates = []
+        for it in rds:
+            fp = it.get("filepath")
+            if fp and (size := _file_size(Path(fp))) is not None:
+                candidates.append((size, Path(fp)))
+        if candidates:
+            return max(candidates, key=lambda x: x[0])[1]
+    # 2) prepare_filename (sometimes the merged file is .mp4, not the predicted ext)
+    if _file_size(predicted) is not None:
+        return predicted
+    # 3) look up by ID in this job's directory
+    vid = info.get("id", "")
+    best = None
+    for f in out_dir.glob(f"*{vid}*"):
+        size = _file_size(f)
+        if size is not None and (not best or size > best[0]):
+            best = (size, f)
+    return best[1] if best else None
 
 async def run_download(
     j: Job,
     user_cookie: Optional[str],
+    cancel: Optional[threading.Event] = None,
 ) -> Tuple[Optional[Path], str, str]:
     """
     Returns: (filepath, sanitized_command_text, short_result_message)
     """
-    yt_dlp = _import_yt_dlp()
+    # the first import of yt_dlp is slow (hundreds of extractors); keep it off the loop
+    yt_dlp = await asyncio.to_thread(_import_yt_dlp)
     log = BufferLogger()
     if yt_dlp is None:
         msg = "yt-dlp is not installed. Run: pip install -U yt-dlp"
@@ -268,17 +570,16 @@ async def run_download(
         return None, "", msg
 
     fmt = build_format_selector(j.fmt or "best")
-    headers = {
-        "User-Agent": "Mozilla/5.0",
-        "Accept-Language": "en-US,en;q=0.9",
-    }
+    headers = dict(BASE_HEADERS)  # copy: the Cookie header is per user
     if user_cookie:
         headers["Cookie"] = user_cookie
 
     if not ffmpeg_present():
         log.warning("ffmpeg not found on system; merging may fail. Install with: apt install ffmpeg")
 
-    outtmpl = str(DOWNLOAD_DIR / "%(title).200B [%(id)s].%(ext)s")
+    out_dir = job_dir(j.jid)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    outtmpl = str(out_dir / OUTTMPL_NAME)
 
     ydl_opts = {
         "outtmpl": outtmpl,
@@ -288,10 +589,22 @@ async def run_download(
         "noprogress": True,
         "quiet": True,
         "no_warnings": True,
-        "concurrent_fragment_downloads": 8,
+        "concurrent_fragment_downloads": YTDLP_FRAGMENTS,
+        "http_chunk_size": YTDLP_CHUNK_MB * 1024 * 1024,
+        "buffersize": YTDLP_BUFFER_KB * 1024,
         "http_headers": headers,
         "logger": log,
     }
+    if cancel is not None:
+        # progress hooks fire per chunk/fragment even with noprogress; raising
+        # here is the one way to stop yt-dlp mid-download from another thread
+        def _cancel_hook(d):
+            if cancel.is_set():
+                raise yt_dlp.utils.DownloadCancelled("Canceled by user")
+        ydl_opts["progress_hooks"] = [_cancel_hook]
+    if uses_aria2c(user_cookie):
+        # yt-dlp already passes -x16 -s16 -k1M --file-allocation=none
+        ydl_opts["external_downloader"] = {"http": "aria2c"}
     if j.force_generic:
         ydl_opts["force_generic_extractor"] = True
 
@@ -300,48 +613,35 @@ async def run_download(
     last_exc_text = ""
 
     for attempt in (1, 2):
+        key = (j.url, bool(ydl_opts.get("force_generic_extractor")), user_cookie or "")
+        cached = info_cache_get(key)
         try:
-            def _do():
+            def _do(reuse: Optional[dict]):
                 with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(j.url, download=True)
-            info = await asyncio.to_thread(_do)
-            # Derive final file path robustly
-            # 1) new 'requested_downloads' API
-            filepath = None
-            rds = info.get("requested_downloads") if isinstance(info, dict) else None
-            if isinstance(rds, list) and rds:
-                # pick the largest file or the last merged file
-                candidates = []
-                for it in rds:
-                    fp = it.get("filepath")
-                    if fp:
-                        p = Path(fp)
-                        if p.exists():
-                            candidates.append((p.stat().st_size, p))
-                if candidates:
-                    filepath = sorted(candidates, key=lambda x: x[0], reverse=True)[0][1]
-            # 2) try prepare_filename
-            if not filepath:
-                def _prep():
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        return Path(ydl.prepare_filename(info))
-                p = await asyncio.to_thread(_prep)
-                # Sometimes the merged file is .mp4 not the ext predicted
-                if p.exists():
-                    filepath = p
-                else:
-                    # Look up by ID in DOWNLOAD_DIR
-                    vid = info.get("id", "")
-                    best = None
-                    for f in DOWNLOAD_DIR.glob(f"*{vid}*"):
-                        if f.is_file():
-                            size = f.stat().st_size
-                            if not best or size > best[0]:
-                                best = (size, f)
-                    if best:
-                        filepath = best[1]
-
-            if not filepath or not filepath.exists():
+                    ie_result = reuse or ydl.extract_info(j.url, download=False, process=False)
+                    if ie_result.get("_type", "video") == "video":
+                        # extract once, then run format selection + download on a copy
+                        info = ydl.process_ie_result(copy.deepcopy(ie_result), download=True)
+                    else:
+                        # playlists/channels hold lazy entries (generators) that
+                        # can't be copied or replayed: download the plain way
+                        info = ydl.extract_info(j.url, download=True)
+                        ie_result = None
+                    # predicted name from the same instance, for the fallback
+                    predicted = Path(ydl.prepare_filename(info))
+                return ie_result, locate_output(info, predicted, out_dir)
+            try:
+                ie_result, filepath = await run_in_ydl_pool(_do, cached)
+            except Exception:
+                if cached is None or (cancel is not None and cancel.is_set()):
+                    raise
+                # the cached media URLs may have expired (often a 403): extract
+                # afresh once before judging the error
+                _INFO_CACHE.pop(key, None)
+                ie_result, filepath = await run_in_ydl_pool(_do, None)
+            if ie_result is not None:
+                info_cache_put(key, ie_result)
+            if filepath is None:
                 raise FileNotFoundError("Downloaded file could not be located after merge.")
 
             # success
@@ -351,14 +651,24 @@ async def run_download(
             return filepath, cmd_text, "ok"
 
         except Exception as e:
+            if cancel is not None and cancel.is_set():
+                return None, "", "canceled"
+            # stale signed URLs are a common cause; re-extract next time
+            _INFO_CACHE.pop(key, None)
             last_exc_text = str(e)
             log.error(last_exc_text)
-            if ("This video is DRM protected" in last_exc_text
-                or "Unsupported DRM" in last_exc_text
-                or "encrypted" in last_exc_text.lower()):
+            err = last_exc_text.lower()  # once, for all marker checks below
+            if any(m in err for m in DRM_MARKERS):
                 return None, "", "drm"
             if j.force_generic or tried_generic:
                 break
+            # the generic extractor hits the same host and would fail the same way
+            if any(m in err for m in NO_GENERIC_RETRY):
+                break
+            # yt-dlp wraps the extractor's exception; geo blocks are typed
+            orig = (getattr(e, "exc_info", None) or (None, None))[1]
+            if isinstance(orig, yt_dlp.utils.GeoRestrictedError):
+                break
             # one retry with generic extractor
             tried_generic = True
             ydl_opts["force_generic_extractor"] = True
@@ -373,25 +683,22 @@ async def run_download(
 
 router = Router()
 
+# (text, act) rows; only the jid changes between jobs
+KB_MAIN_LAYOUT: Tuple[Tuple[Tuple[str, str], ...], ...] = (
+    (("Best", "fmt_best"), ("1080p", "fmt_1080"), ("720p", "fmt_720")),
+    (("📋 Paste Cookie header", "cookie"),),
+    (("🔁 Recheck now", "recheck"), ("🧪 Force generic", "generic")),
+    (("📄 Show log", "log"), ("🔧 Show command", "cmd")),
+    (("✖️ Cancel", "cancel"),),
+)
+
+# panels are re-sent for the same job on every status change; markups are never mutated
+@functools.lru_cache(maxsize=256)
 def kb_main(jid: str) -> InlineKeyboardMarkup:
-    b = InlineKeyboardBuilder()
-    # quality row
-    b.button(text="Best", callback_data=f"act=fmt_best|jid={jid}")
-    b.button(text="1080p", callback_data=f"act=fmt_1080|jid={jid}")
-    b.button(text="720p", callback_data=f"act=fmt_720|jid={jid}")
-    b.adjust(3)
-    # tools
-    b.button(text="📋 Paste Cookie header", callback_data=f"act=cookie|jid={jid}")
-    b.adjust(1)
-    b.button(text="🔁 Recheck now", callback_data=f"act=recheck|jid={jid}")
-    b.button(text="🧪 Force generic", callback_data=f"act=generic|jid={jid}")
-    b.adjust(2)
-    b.button(text="📄 Show log", callback_data=f"act=log|jid={jid}")
-    b.button(text="🔧 Show command", callback_data=f"act=cmd|jid={jid}")
-    b.adjust(2)
-    b.button(text="✖️ Cancel", callback_data=f"act=cancel|jid={jid}")
-    b.adjust(1)
-    return b.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=text, callback_data=f"act={act}|jid={jid}") for text, act in row]
+        for row in KB_MAIN_LAYOUT
+    ])
 
 def parse_cb(data: str) -> Dict[str, str]:
     # "act=fmt_720|jid=UUID"
@@ -402,6 +709,20 @@ def parse_cb(data: str) -> Dict[str, str]:
             out[k] = v
     return out
 
+async def tg_retry(call, attempts: int = 3):
+    """
+    Await `call()` (a Telegram API request), sleeping out flood-wait (429)
+    responses instead of failing. Bursts come from multi-URL messages and
+    many jobs finishing at once.
+    """
+    for attempt in range(attempts):
+        try:
+            return await call()
+        except TelegramRetryAfter as e:
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(e.retry_after)
+
 async def send_controls(msg: Message, url: str, j: Job) -> None:
     caption = (
         f"URL: {url}\n"
@@ -409,7 +730,7 @@ async def send_controls(msg: Message, url: str, j: Job) -> None:
         f"Status: {j.status}\n\n"
         f"Pick a quality or paste cookies / force generic if needed."
     )
-    await msg.answer(caption, reply_markup=kb_main(j.jid))
+    await tg_retry(lambda: msg.answer(caption, reply_markup=kb_main(j.jid)))
 
 # --- Handlers ---------------------------------------------------------------
 
@@ -428,37 +749,157 @@ async def on_start(m: Message):
 async def on_status(m: Message):
     con = db()
     rows = con.execute("SELECT status, COUNT(*) c FROM jobs GROUP BY status").fetchall()
-    con.close()
     parts = [f"{r['status']}: {r['c']}" for r in rows] or ["no jobs"]
     await m.answer(
-        "Jobs → " + ", ".join(parts) + f"\nDownloads dir: <code>{DOWNLOAD_DIR}</code>\n{disk_usage_str(DOWNLOAD_DIR)}"
+        "Jobs → " + ", ".join(parts)
+        + f"\nRunning: {ADMISSION.active}/{ADMISSION.cap}, queued: {ADMISSION.waiting}"
+        + f"\nDownloads dir: <code>{DOWNLOAD_DIR}</code>\n{disk_usage_str(DOWNLOAD_DIR)}"
     )
 
 @router.message(Command("clean"))
 async def on_clean(m: Message):
-    # delete files older than 3 days to free space
-    cutoff = time.time() - 3 * 24 * 3600
-    removed = 0
-    for p in DOWNLOAD_DIR.glob("*"):
-        with contextlib.suppress(Exception):
-            if p.is_file() and p.stat().st_mtime < cutoff:
-                p.unlink()
-                removed += 1
-    await m.answer(f"Cleaned {removed} old files from {DOWNLOAD_DIR}.")
-
-@router.message()
+    # delete files older than 3 days to free space (off the event loop)
+    removed = await asyncio.to_thread(purge_old_files, DOWNLOAD_DIR, 3 * 24 * 3600)
+    pruned = job_purge(3 * 24 * 3600)
+    await m.answer(f"Cleaned {removed} old files/job folders from {DOWNLOAD_DIR}, {pruned} old job records.")
+
+@router.message(Command("setconcurrent"))
+async def on_setconcurrent(m: Message, command: CommandObject):
+    if not ADMIN_ID or m.from_user.id != ADMIN_ID:
+        return
+    arg = (command.args or "").strip()
+    if not arg.isdigit() or int(arg) < 1:
+        await m.answer(f"Usage: <code>/setconcurrent N</code> (current: {ADMISSION.cap})")
+        return
+    await ADMISSION.set_cap(int(arg))
+    capped = f" (max {DL_WORKERS}, see DL_WORKERS)" if int(arg) > ADMISSION.cap else ""
+    await m.answer(f"Concurrent downloads set to {ADMISSION.cap}{capped}.")
+
+def message_urls(m: Message) -> List[str]:
+    # Telegram already located the links (incl. hidden text_link targets);
+    # the regex only runs for messages it didn't annotate
+    urls = []
+    for e in m.entities or ():
+        if e.type == "url":
+            urls.append(e.extract_from(m.text))  # offsets are UTF-16, let aiogram slice
+        elif e.type == "text_link" and e.url:
+            urls.append(e.url)
+    urls = [u for u in urls if u.lower().startswith(("http://", "https://"))]
+    return list(dict.fromkeys(urls)) if urls else extract_urls(m.text)
+
+def has_link(m: Message) -> bool:
+    # plain substring/entity gate: chatter never reaches the regex, and
+    # cookie replies to a panel fall through to on_cookie_reply below
+    if not m.text:
+        return False
+    return "://" in m.text or any(e.type == "text_link" for e in m.entities or ())
+
+@router.message(has_link)
 async def on_message_url(m: Message):
-    url = extract_url(m.text or "")
-    if not url:
+    urls = message_urls(m)
+    if not urls:
         return  # ignore non-URLs
-    j = job_create(m.from_user.id, url=url, fmt=None, force_generic=False)
-    await send_controls(m, url, j)
+    # one job + control panel per URL so several links can be queued at once
+    for url in urls[:MAX_URLS_PER_MSG]:
+        j = job_create(m.from_user.id, url=url, fmt=None, force_generic=False)
+        await send_controls(m, url, j)
+    if len(urls) > MAX_URLS_PER_MSG:
+        await m.answer(f"Only the first {MAX_URLS_PER_MSG} links were taken; send the rest separately.")
+
+# Callback actions: one coroutine per button, looked up by "act" in CB_ACTIONS
+# instead of walking an if-chain. Each gets the resolved job and panel URL.
+
+FMT_CHOICES = {"fmt_best": "best", "fmt_1080": "1080p", "fmt_720": "720p"}
+
+async def cb_format(cb: CallbackQuery, j: Job, act: str, url_in_msg: str):
+    if j.jid in CANCEL_EVENTS:
+        await cb.answer(ALREADY_RUNNING)
+        return
+    choice = FMT_CHOICES[act]
+    j.fmt = choice
+    job_update(j)
+    start_download(cb, j)
+    await cb.answer(f"Starting {choice}…")
+
+async def cb_cookie(cb: CallbackQuery, j: Job, act: str, url_in_msg: str):
+    # starts with "URL: " like the panel, so on_cookie_reply picks up replies to it
+    await cb.message.answer(
+        f"URL: {html_escape(url_in_msg)}\n"
+        "Reply to <b>this message</b> with your <code>Cookie</code> header copied from your browser.\n"
+        "Example:\n<code>Cookie: key1=value1; key2=value2; ...</code>\n\n"
+        "Tip: You can omit the leading <code>Cookie:</code> — I’ll handle it.",
+    )
+    await cb.answer()
+
+async def cb_recheck(cb: CallbackQuery, j: Job, act: str, url_in_msg: str):
+    if j.jid in CANCEL_EVENTS:
+        await cb.answer(ALREADY_RUNNING)
+        return
+    start_download(cb, j, fresh=True)
+    await cb.answer("Rechecking…")
+
+async def cb_generic(cb: CallbackQuery, j: Job, act: str, url_in_msg: str):
+    if j.jid in CANCEL_EVENTS:
+        await cb.answer(ALREADY_RUNNING)
+        return
+    j.force_generic = True
+    job_update(j)
+    start_download(cb, j, fresh=True)
+    await cb.answer("Will use generic extractor.")
+
+async def cb_log(cb: CallbackQuery, j: Job, act: str, url_in_msg: str):
+    txt = j.log or "(empty)"
+    if len(txt) > 3500:
+        txt = txt[-3500:]
+    await cb.message.answer(f"<b>Last log</b> (tail):\n<code>{html_escape(txt)}</code>")
+    await cb.answer()
+
+async def cb_cmd(cb: CallbackQuery, j: Job, act: str, url_in_msg: str):
+    # Reconstruct a sanitized command preview
+    fmt = build_format_selector(j.fmt or "best")
+    outtmpl = str(job_dir(j.jid) / OUTTMPL_NAME)
+    cookie = cookie_get(j.user_id, domain_from_url(j.url))
+    cmd = f"yt-dlp -o '{outtmpl}' -f \"{fmt}\""
+    if j.force_generic:
+        cmd += " --force-generic-extractor"
+    if cookie:
+        cmd += f"\n# Cookie: {sanitized_cookie_preview(cookie)}"
+    await cb.message.answer(f"<b>Command used</b>:\n<code>{html_escape(cmd)}</code>")
+    await cb.answer()
+
+async def cb_cancel(cb: CallbackQuery, j: Job, act: str, url_in_msg: str):
+    ev = CANCEL_EVENTS.get(j.jid)
+    if ev is not None:
+        ev.set()  # stops a queued job before it starts, a running one at its next chunk
+        await ADMISSION.wake()  # a queued job leaves the line now, not when a slot frees
+    # aria2c reports no progress, so a running aria2c job only sees the event
+    # once its file is complete; it is then dropped instead of uploaded
+    via_aria2c = j.status == "running" and uses_aria2c(cookie_get(j.user_id, domain_from_url(j.url)))
+    j.status = "canceled"
+    job_update(j)
+    note = "\n(aria2c can't be interrupted mid-file; it won't be uploaded)" if via_aria2c else ""
+    await cb.answer("Canceled." + note)
+    await cb.message.edit_text(f"URL: {url_in_msg}\nJob: <code>{j.jid}</code>\nStatus: canceled{note}")
+
+CB_ACTIONS = {
+    **{act: cb_format for act in FMT_CHOICES},
+    "cookie": cb_cookie,
+    "recheck": cb_recheck,
+    "generic": cb_generic,
+    "log": cb_log,
+    "cmd": cb_cmd,
+    "cancel": cb_cancel,
+}
 
 @router.callback_query(F.data.startswith("act="))
 async def on_cb(cb: CallbackQuery):
     data = parse_cb(cb.data or "")
     act = data.get("act", "")
     jid = data.get("jid", "")
+    handler = CB_ACTIONS.get(act)
+    if handler is None:
+        await cb.answer()
+        return
     j = job_get(jid) if jid else None
 
     # If job missing → rebuild from message's URL (prevents "Job missing")
@@ -475,66 +916,10 @@ async def on_cb(cb: CallbackQuery):
     if not url_in_msg:
         url_in_msg = j.url
 
-    if act.startswith("fmt_"):
-        choice = "best" if act == "fmt_best" else ("1080p" if act == "fmt_1080" else "720p")
-        j.fmt = choice
-        job_update(j)
-        await cb.answer(f"Starting {choice}…")
-        asyncio.create_task(process_download(cb, j))
-        return
-
-    if act == "cookie":
-        await cb.message.answer(
-            "Reply to <b>this message</b> with your <code>Cookie</code> header copied from your browser.\n"
-            "Example:\n<code>Cookie: key1=value1; key2=value2; ...</code>\n\n"
-            "Tip: You can omit the leading <code>Cookie:</code> — I’ll handle it.",
-        )
-        await cb.answer()
-        return
-
-    if act == "recheck":
-        await cb.answer("Rechecking…")
-        asyncio.create_task(process_download(cb, j, fresh=True))
-        return
-
-    if act == "generic":
-        j.force_generic = True
-        job_update(j)
-        await cb.answer("Will use generic extractor.")
-        asyncio.create_task(process_download(cb, j, fresh=True))
-        return
-
-    if act == "log":
-        txt = j.log or "(empty)"
-        if len(txt) > 3500:
-            txt = txt[-3500:]
-        await cb.message.answer(f"<b>Last log</b> (tail):\n<code>{html_escape(txt)}</code>")
-        await cb.answer()
-        return
-
-    if act == "cmd":
-        # Reconstruct a sanitized command preview
-        fmt = build_format_selector(j.fmt or "best")
-        outtmpl = str(DOWNLOAD_DIR / "%(title).200B [%(id)s].%(ext)s")
-        cookie = cookie_get(j.user_id, domain_from_url(j.url))
-        cmd = f"yt-dlp -o '{outtmpl}' -f \"{fmt}\""
-        if j.force_generic:
-            cmd += " --force-generic-extractor"
-        if cookie:
-            cmd += f"\n# Cookie: {sanitized_cookie_preview(cookie)}"
-        await cb.message.answer(f"<b>Command used</b>:\n<code>{html_escape(cmd)}</code>")
-        await cb.answer()
-        return
-
-    if act == "cancel":
-        j.status = "canceled"
-        job_update(j)
-        await cb.answer("Canceled.")
-        await cb.message.edit_text(f"URL: {url_in_msg}\nJob: <code>{j.jid}</code>\nStatus: canceled")
-        return
+    await handler(cb, j, act, url_in_msg)
 
 # Cookie capture: user replies to bot message with cookie header
-@router.message(F.reply_to_message.as_({"text": F.startswith("URL: ")}))
+@router.message(F.reply_to_message.text.startswith("URL: "))
 async def on_cookie_reply(m: Message):
     # Accept either "Cookie: ..." or raw "key=val; key2=val2"
     text = (m.text or "").strip()
@@ -552,50 +937,86 @@ async def on_cookie_reply(m: Message):
 
 # --- Download worker --------------------------------------------------------
 
+# Strong refs to fire-and-forget tasks: the loop only keeps weak ones, and an
+# unreferenced task can be garbage-collected mid-download.
+BG_TASKS: "set[asyncio.Task]" = set()
+
+# jid -> cancel flag of the run in progress; set from the loop (Cancel button),
+# read from the yt-dlp thread in its progress hook. One run per job at a time,
+# so Cancel always reaches the run that is actually downloading.
+CANCEL_EVENTS: Dict[str, threading.Event] = {}
+ALREADY_RUNNING = "Still running (or stopping); try again once it ends."
+
+def spawn(coro) -> asyncio.Task:
+    t = asyncio.create_task(coro)
+    BG_TASKS.add(t)
+    t.add_done_callback(_bg_task_done)
+    return t
+
+def _bg_task_done(t: asyncio.Task) -> None:
+    BG_TASKS.discard(t)
+    if not t.cancelled() and t.exception() is not None:
+        logging.getLogger("bot").error("background task failed", exc_info=t.exception())
+
 def html_escape(s: str) -> str:
     return (s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;"))
 
-async def process_download(cb: CallbackQuery, j: Job, fresh: bool = False):
-    # Prepare
-    if fresh:
-        j.status = "pending"
-        j.filepath = None
-        j.log = ""
-        job_update(j)
+def start_download(cb: CallbackQuery, j: Job, fresh: bool = False) -> None:
+    # registered before the task runs, so a second button press sees it at once
+    cancel = CANCEL_EVENTS[j.jid] = threading.Event()
+    spawn(process_download(cb, j, cancel, fresh=fresh))
 
-    # Load cookie for this domain/user
-    cookie = cookie_get(j.user_id, domain_from_url(j.url))
+async def process_download(cb: CallbackQuery, j: Job, cancel: threading.Event, fresh: bool = False):
+    try:
+        # Prepare
+        if fresh:
+            info_cache_drop(j.url)
+            j.status = "pending"
+            j.filepath = None
+            j.log = ""
+            job_update(j)
+
+        # Load cookie for this domain/user
+        cookie = cookie_get(j.user_id, domain_from_url(j.url))
 
-    # Mark running
-    j.status = "running"
-    job_update(j)
+        # Wait for a free slot, then mark running; tell the user when they're queued
+        queued = ADMISSION.full
+        if queued:
+            j.status = "queued"
+            job_update(j)
+            await safe_edit_status(cb, j, extra=f"{ADMISSION.waiting + 1} in line")
+        async with ADMISSION.slot(cancel) as admitted:
+            if not admitted:
+                return  # canceled while queued; cb_cancel already updated the panel
+            j.status = "running"
+            job_update(j)
+            if queued:
+                await safe_edit_status(cb, j)
+
+            # Run
+            path, cmd_text, result = await run_download(j, user_cookie=cookie, cancel=cancel)
+    finally:
+        if CANCEL_EVENTS.get(j.jid) is cancel:
+            del CANCEL_EVENTS[j.jid]
 
-    # Run
-    path, cmd_text, result = await run_download(j, user_cookie=cookie)
+    if result == "canceled":
+        j.status = "canceled"
+        j.log = (j.log or "") + "\nCanceled by user."
+        job_update(j)
+        return
 
     # Handle outcomes
     if result == "ok" and path:
         j.status = "done"
         j.filepath = str(path)
+        # one stat, reused for the log and the upload decision; off the loop
+        # since DOWNLOAD_DIR may sit on slow or network storage
+        size = (await asyncio.to_thread(path.stat)).st_size
         # Append short success log
-        j.log = (j.log or "") + f"\nSaved: {path} ({human_bytes(path.stat().st_size)})"
+        j.log = (j.log or "") + f"\nSaved: {path} ({human_bytes(size)})"
         job_update(j)
-        try:
-            # Telegram limits: ~2GB for most accounts
-            size = path.stat().st_size
-            if size <= 1_900_000_000:
-                await cb.message.answer_document(
-                    document=path.open("rb"),
-                    caption=f"✅ Done\n<code>{path.name}</code>\n{human_bytes(size)}",
-                )
-            else:
-                await cb.message.answer(
-                    f"✅ Done (local save)\n<code>{html_escape(str(path))}</code>\n{human_bytes(size)}\n"
-                    f"Too large to send via Telegram."
-                )
-        except Exception as e:
-            await cb.message.answer(f"Saved to: <code>{html_escape(str(path))}</code>\n(send failed: {html_escape(str(e))})")
-        await safe_edit_status(cb, j, extra="done")
+        # the panel edit doesn't depend on the upload; run both at once
+        await asyncio.gather(send_result(cb, path, size), safe_edit_status(cb, j, extra="done"))
         return
 
     if result == "drm":
@@ -621,13 +1042,33 @@ async def process_download(cb: CallbackQuery, j: Job, fresh: bool = False):
     await cb.message.answer("❌ Download failed.\n" + "\n".join(f"• {h}" for h in hints))
     await safe_edit_status(cb, j, extra="failed")
 
+async def send_result(cb: CallbackQuery, path: Path, size: int):
+    try:
+        # Telegram limits: ~2GB for most accounts
+        if size <= 1_900_000_000:
+            async with upload_cache_hints(path):
+                await cb.message.answer_document(
+                    document=FSInputFile(path, chunk_size=UPLOAD_CHUNK_KB * 1024),
+                    caption=f"✅ Done\n<code>{html_escape(path.name)}</code>\n{human_bytes(size)}",
+                )
+            if DELETE_AFTER_UPLOAD and path.parent.parent == DOWNLOAD_DIR:
+                # whole job folder: the file plus any .part/.ytdl leftovers
+                spawn(asyncio.to_thread(shutil.rmtree, path.parent, ignore_errors=True))
+        else:
+            await cb.message.answer(
+                f"✅ Done (local save)\n<code>{html_escape(str(path))}</code>\n{human_bytes(size)}\n"
+                f"Too large to send via Telegram."
+            )
+    except Exception as e:
+        await cb.message.answer(f"Saved to: <code>{html_escape(str(path))}</code>\n(send failed: {html_escape(str(e))})")
+
 async def safe_edit_status(cb: CallbackQuery, j: Job, extra: str = ""):
     try:
         url_in_msg = extract_url(cb.message.text or "") if cb.message else j.url
-        await cb.message.edit_text(
+        await tg_retry(lambda: cb.message.edit_text(
             f"URL: {url_in_msg}\nJob: <code>{j.jid}</code>\nStatus: {j.status}{(' — ' + extra) if extra else ''}",
             reply_markup=kb_main(j.jid),
-        )
+        ))
     except Exception:
         pass
 
@@ -635,7 +1076,10 @@ async def safe_edit_status(cb: CallbackQuery, j: Job, extra: str = ""):
 
 async def main():
     init_db()
-    bot = Bot(BOT_TOKEN, parse_mode=ParseMode.HTML)
+    session = None
+    if orjson is not None:
+        session = AiohttpSession(json_loads=orjson.loads, json_dumps=lambda o: orjson.dumps(o).decode())
+    bot = Bot(BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     dp = Dispatcher()
     dp.include_router(router)
 
@@ -643,10 +1087,31 @@ async def main():
     if not ffmpeg_present():
         print("[warn] ffmpeg not found; install with: sudo apt install -y ffmpeg")
 
-    await dp.start_polling(bot)
+    try:
+        # keep the session open after polling stops so in-flight jobs can still reply
+        await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        # give running downloads a grace period, then cancel what's left
+        if BG_TASKS:
+            _, pending = await asyncio.wait(set(BG_TASKS), timeout=SHUTDOWN_GRACE)
+            for ev in CANCEL_EVENTS.values():
+                ev.set()  # lets their yt-dlp threads stop too, not just the tasks
+            for t in pending:
+                t.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        # drop queued yt-dlp work; running threads exit at their next progress hook
+        YDL_POOL.shutdown(wait=False, cancel_futures=True)
+        await bot.session.close()
+        if _CON is not None:
+            _CON.close()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        import uvloop  # optional: libuv event loop, falls back to asyncio's default
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
+    try:
+        run(main())
     except (KeyboardInterrupt, SystemExit):
         print("Bot stopped.")
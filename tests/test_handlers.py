@@ -0,0 +1,192 @@
+import asyncio
+import datetime as dt
+import importlib
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+ROOT = Path(__file__).resolve().parent.parent
+USER = User(id=7, is_bot=False, first_name="u")
+CHAT = Chat(id=7, type="private")
+
+
+class RecordingSession(BaseSession):
+    """Answers every API call locally and keeps the methods that were sent."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.sent.append(method)
+        return Message(message_id=1000 + len(self.sent), date=dt.datetime.now(), chat=CHAT, text="ok")
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class Harness:
+    def __init__(self, mod):
+        self.mod = mod
+        self.session = RecordingSession()
+        self.bot = Bot("42:TEST", session=self.session)
+        self.dp = Dispatcher()
+        self.dp.include_router(mod.router)
+
+    def feed(self, **update):
+        return asyncio.run(self.dp.feed_update(self.bot, Update(update_id=1, **update)))
+
+
+@pytest.fixture()
+def mod(tmp_path, monkeypatch):
+    monkeypatch.setenv("BOT_TOKEN", "42:TEST")
+    monkeypatch.setenv("DOWNLOAD_DIR", str(tmp_path / "out"))
+    monkeypatch.setenv("DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.syspath_prepend(str(ROOT))
+    sys.modules.pop("bot", None)
+    mod = importlib.import_module("bot")
+    mod.init_db()
+    yield mod
+    if mod._CON is not None:
+        mod._CON.close()
+    sys.modules.pop("bot", None)
+
+
+@pytest.fixture()
+def h(mod):
+    return Harness(mod)
+
+
+def _msg(text, message_id=1, reply_to=None, **kw):
+    return Message(
+        message_id=message_id, date=dt.datetime.now(), chat=CHAT, from_user=USER,
+        text=text, reply_to_message=reply_to, **kw,
+    )
+
+
+def test_plain_reply_without_link_is_ignored(h):
+    h.feed(message=_msg("thanks!", 2, reply_to=_msg("some earlier chat")))
+    assert h.session.sent == []
+
+
+def test_cookie_reply_to_panel_is_saved(h):
+    panel = _msg("URL: https://example.com/watch?v=1\nJob: x\nStatus: pending")
+    h.feed(message=_msg("Cookie: a=1; b=2", 2, reply_to=panel))
+    assert h.mod.cookie_get(USER.id, "example.com") == "a=1; b=2"
+    assert len(h.session.sent) == 1
+
+
+def test_cookie_reply_to_prompt_is_saved(h):
+    j = h.mod.job_create(USER.id, "https://example.com/v/2")
+    panel = _msg(f"URL: {j.url}\nJob: {j.jid}", 5)
+    cb = CallbackQuery(
+        id="1", from_user=USER, chat_instance="c", message=panel,
+        data=f"act=cookie|jid={j.jid}",
+    )
+    h.feed(callback_query=cb)
+    prompt = next(m for m in h.session.sent if type(m).__name__ == "SendMessage")
+
+    # the user's client shows the prompt as plain text (tags stripped, entities decoded)
+    prompt_text = re.sub(r"<[^>]+>", "", prompt.text).replace("&amp;", "&")
+    h.feed(message=_msg("a=1; b=2", 6, reply_to=_msg(prompt_text, 5)))
+    assert h.mod.cookie_get(USER.id, "example.com") == "a=1; b=2"
+
+
+def test_upload_hints_stay_off_the_loop(h, tmp_path, monkeypatch):
+    import os
+    import threading
+
+    calls = []
+    monkeypatch.setattr(os, "posix_fadvise", lambda fd, off, ln, advice: calls.append(
+        (advice, threading.current_thread() is threading.main_thread())), raising=False)
+    monkeypatch.setattr(os, "POSIX_FADV_SEQUENTIAL", 2, raising=False)
+    monkeypatch.setattr(os, "POSIX_FADV_DONTNEED", 4, raising=False)
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(b"x" * 10)
+    cb = CallbackQuery(
+        id="1", from_user=USER, chat_instance="c", message=_msg("URL: x", 5).as_(h.bot), data="act=best",
+    )
+
+    asyncio.run(h.mod.send_result(cb, path, 10))
+    doc = next(m for m in h.session.sent if type(m).__name__ == "SendDocument")
+    assert doc.document.chunk_size == h.mod.UPLOAD_CHUNK_KB * 1024
+    assert calls == [(os.POSIX_FADV_SEQUENTIAL, False), (os.POSIX_FADV_DONTNEED, False)]
+
+
+def test_stale_running_job_is_failed_on_startup(h):
+    j = h.mod.job_create(USER.id, "https://example.com/v/3")
+    j.status = "running"
+    h.mod.job_update(j)
+    h.mod._CON.execute("UPDATE jobs SET updated_at = 0 WHERE jid = ?", (j.jid,))
+
+    h.mod.init_db()
+    assert h.mod.job_get(j.jid).status == "failed"
+    assert h.mod.job_purge(60) == 0  # marked now, so it ages out like any finished row
+
+
+def test_job_canceled_while_queued_leaves_the_line(h):
+    import threading
+
+    async def scenario():
+        adm = h.mod.Admission(1, 1)
+        cancel = threading.Event()
+        async with adm:
+            async def queued():
+                async with adm.slot(cancel) as admitted:
+                    return admitted
+            t = asyncio.create_task(queued())
+            await asyncio.sleep(0)
+            assert adm.waiting == 1
+            cancel.set()
+            await adm.wake()
+            assert await asyncio.wait_for(t, 1) is False
+            assert (adm.active, adm.waiting) == (1, 0)
+        assert adm.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_second_run_is_refused_while_one_is_active(h, monkeypatch):
+    runs = []
+
+    async def fake_download(cb, j, cancel, fresh=False):
+        runs.append(cancel)
+        await asyncio.sleep(3600)
+    monkeypatch.setattr(h.mod, "process_download", fake_download)
+    j = h.mod.job_create(USER.id, "https://example.com/v/4")
+    panel = _msg(f"URL: {j.url}\nJob: {j.jid}", 5)
+
+    def press(act):
+        cb = CallbackQuery(id="1", from_user=USER, chat_instance="c", message=panel, data=f"act={act}|jid={j.jid}")
+        return h.dp.feed_update(h.bot, Update(update_id=1, callback_query=cb))
+
+    async def scenario():
+        await press("fmt_best")
+        await asyncio.sleep(0)
+        await press("recheck")
+        await press("cancel")
+
+    asyncio.run(scenario())
+    answers = [m.text for m in h.session.sent if type(m).__name__ == "AnswerCallbackQuery"]
+    assert answers[1] == h.mod.ALREADY_RUNNING
+    assert len(runs) == 1 and runs[0].is_set()
+
+
+def test_main_starts_polling_and_shuts_down(mod, monkeypatch):
+    polled = []
+
+    async def fake_polling(self, *bots, **kwargs):
+        polled.extend(bots)
+    monkeypatch.setattr(Dispatcher, "start_polling", fake_polling)
+
+    asyncio.run(mod.main())
+    assert polled[0].default.parse_mode == "HTML"
@@ -0,0 +1,98 @@
+import asyncio
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+import yt_dlp
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class FakeYDL:
+    """Stands in for yt_dlp.YoutubeDL; tests set `make_ie_result` and read `calls`."""
+
+    make_ie_result = None
+    calls = []
+
+    def __init__(self, opts):
+        self.out = Path(opts["outtmpl"]).parent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=True, process=True):
+        FakeYDL.calls.append(("extract_info", download, process))
+        if not process:
+            return FakeYDL.make_ie_result()
+        return self._download({"id": "pl", "title": "list"})
+
+    def process_ie_result(self, ie_result, download=True):
+        FakeYDL.calls.append(("process_ie_result", ie_result.get("url")))
+        if ie_result.get("url") == "expired":
+            raise yt_dlp.utils.DownloadError("ERROR: unable to download video data: HTTP Error 403: Forbidden")
+        return self._download(ie_result)
+
+    def prepare_filename(self, info):
+        return str(self.out / f"{info['id']}.mp4")
+
+    def _download(self, info):
+        path = self.out / f"{info['id']}.mp4"
+        path.write_bytes(b"x")
+        return {**info, "requested_downloads": [{"filepath": str(path)}]}
+
+
+@pytest.fixture()
+def bot(tmp_path, monkeypatch):
+    monkeypatch.setenv("BOT_TOKEN", "42:TEST")
+    monkeypatch.setenv("DOWNLOAD_DIR", str(tmp_path / "out"))
+    monkeypatch.setenv("DB_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.syspath_prepend(str(ROOT))
+    monkeypatch.setattr(yt_dlp, "YoutubeDL", FakeYDL)
+    FakeYDL.calls = []
+    sys.modules.pop("bot", None)
+    mod = importlib.import_module("bot")
+    mod.init_db()
+    yield mod
+    mod._CON.close()
+    sys.modules.pop("bot", None)
+
+
+def _run(mod, url):
+    j = mod.job_create(7, url)
+    return asyncio.run(mod.run_download(j, user_cookie=None))
+
+
+def test_video_result_is_cached_and_reused(bot):
+    FakeYDL.make_ie_result = lambda: {"id": "v1", "url": "https://cdn/v1"}
+    assert _run(bot, "https://example.com/v1")[2] == "ok"
+    assert _run(bot, "https://example.com/v1")[2] == "ok"
+    assert [c[0] for c in FakeYDL.calls] == ["extract_info", "process_ie_result", "process_ie_result"]
+
+
+def test_playlist_downloads_without_copy_or_cache(bot):
+    def lazy_playlist():
+        return yt_dlp.extractor.common.InfoExtractor.playlist_result(
+            ({"id": str(i)} for i in range(2)), "pl", "list")
+    FakeYDL.make_ie_result = lazy_playlist
+
+    path, _, result = _run(bot, "https://example.com/channel")
+    assert result == "ok" and path.name == "pl.mp4"
+    assert FakeYDL.calls == [("extract_info", False, False), ("extract_info", True, True)]
+    assert bot._INFO_CACHE == {}
+
+
+def test_expired_cache_hit_is_extracted_again(bot):
+    FakeYDL.make_ie_result = lambda: {"id": "v2", "url": "https://cdn/v2"}
+    bot.info_cache_put(("https://example.com/v2", False, ""), {"id": "v2", "url": "expired"})
+
+    path, _, result = _run(bot, "https://example.com/v2")
+    assert result == "ok" and path.name == "v2.mp4"
+    assert FakeYDL.calls == [
+        ("process_ie_result", "expired"),
+        ("extract_info", False, False),
+        ("process_ie_result", "https://cdn/v2"),
+    ]